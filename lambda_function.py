@@ -1,13 +1,17 @@
 import boto3
 import json
+import gzip
 import io
-import csv
-import time
 import logging
-import random
+import queue
+import re
+import tempfile
+import threading
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime, timedelta, timezone
 from zoneinfo import ZoneInfo
-import botocore.exceptions
+from boto3.s3.transfer import TransferConfig
+from botocore.config import Config
 import os
 
 # -----------------------
@@ -17,10 +21,62 @@ logger = logging.getLogger()
 logger.setLevel(logging.INFO)
 
 # -----------------------
-# Load configuration
+# Tuning
+# -----------------------
+# Hours are processed concurrently when no Step Function is configured, so the
+# shared clients need a connection pool larger than botocore's default of 10.
+CLIENT_CONFIG = Config(max_pool_connections=32, retries={"mode": "adaptive"})
+# LookupEvents is capped at 2 req/s per region; adaptive mode's client-side token
+# bucket paces every thread sharing the client to stay under it.
+CLIENT_CONFIG_OVERRIDES = {
+    "cloudtrail": Config(retries={"mode": "adaptive", "max_attempts": 10}),
+}
+HOUR_WORKERS = 8
+ATHENA_WORKERS = 32
+PREFETCH_PAGES = 4
+
+# Reports are spooled to memory up to one part size, then to /tmp, and uploaded
+# as a parallel multipart upload once they grow past it.
+UPLOAD_PART_SIZE = 8 * 1024 * 1024
+TRANSFER_CONFIG = TransferConfig(
+    multipart_threshold=UPLOAD_PART_SIZE,
+    multipart_chunksize=UPLOAD_PART_SIZE,
+    max_concurrency=8,
+)
+# Level 1 is nearly free on CPU and still shrinks the repetitive report rows a lot.
+GZIP_LEVEL = 1
+
+# -----------------------
+# AWS clients
 # -----------------------
-s3 = boto3.client('s3')
+# Clients are created on first use, so cold starts only pay for the ones a given
+# invocation actually needs (e.g. Step Functions only on the daily trigger).
+_clients = {}
+_client_lock = threading.Lock()
+
+def get_client(name):
+    client = _clients.get(name)
+    if client is None:
+        # boto3's default session is not thread-safe while building clients, and
+        # threads racing on first use must all end up with the same client (the
+        # adaptive retry token bucket is per client).
+        with _client_lock:
+            client = _clients.get(name)
+            if client is None:
+                client_config = CLIENT_CONFIG
+                if name in CLIENT_CONFIG_OVERRIDES:
+                    client_config = client_config.merge(CLIENT_CONFIG_OVERRIDES[name])
+                client = _clients[name] = boto3.client(name, config=client_config)
+    return client
 
+# One pool for every Athena lookup in the container, rather than a pool per hour
+# nested inside the hour threads; it caps in-flight GetQueryExecution calls at the
+# size of the connection pool. Threads are started lazily and reused while warm.
+athena_executor = ThreadPoolExecutor(max_workers=ATHENA_WORKERS, thread_name_prefix="athena")
+
+# -----------------------
+# Load configuration
+# -----------------------
 config = {
     "AWS_ACCOUNT_ID": os.environ.get("AWS_ACCOUNT_ID"),
     "LAMBDA_NAME": os.environ.get("LAMBDA_NAME"),
@@ -38,120 +94,273 @@ if not all([config["AWS_ACCOUNT_ID"], config["LAMBDA_NAME"], config["S3_BUCKET"]
     CONFIG_KEY = os.environ.get("CONFIG_KEY", "config.json")
     if CONFIG_BUCKET:
         try:
-            obj = s3.get_object(Bucket=CONFIG_BUCKET, Key=CONFIG_KEY)
+            obj = get_client('s3').get_object(Bucket=CONFIG_BUCKET, Key=CONFIG_KEY)
             s3_config = json.loads(obj['Body'].read())
             config.update(s3_config)
             logger.info("Loaded configuration from S3 config.json")
         except Exception as e:
             logger.error(f"Failed to load config.json from S3: {e}")
 
-# -----------------------
-# AWS clients
-# -----------------------
-cloudtrail = boto3.client('cloudtrail')
-athena = boto3.client('athena')
-stepfunctions = boto3.client('stepfunctions')
-
 TIMEZONE_EST = ZoneInfo("America/New_York")
 STATE_FILE_KEY_TEMPLATE = "hourly-state/{date}.json"
+QUERY_ID_PATTERN = re.compile(r'"queryExecutionId"\s*:\s*"([0-9a-f-]{36})"')
+
+# CSV rows are assembled directly; only free-text fields can need quoting.
+CSV_HEADER = ("LambdaRunTime(EST),Username,QueryStartTime(EST),QueryEndTime(EST),"
+              "Query,QueryExecutionId,Athena_Workgroup\r\n")
+CSV_SPECIAL_CHARS = re.compile(r'[,"\r\n]')
+
+# JSON reports carry the field names once, followed by one array per record.
+REPORT_FIELDS = ("lambda_runtime", "username", "start_time", "end_time",
+                 "query", "query_execution_id", "workgroup")
+
+# Finished query executions never change, so they are kept for the lifetime of
+# a warm container. Running/queued ones are not cached since their end time,
+# state and stats are still moving.
+QUERY_CACHE_SIZE = 4096
+FINAL_QUERY_STATES = {"SUCCEEDED", "FAILED", "CANCELLED"}
+_query_cache = {}
+_query_cache_lock = threading.Lock()
 
 # -----------------------
 # Helper functions
 # -----------------------
-def s3_object_exists(bucket, key):
-    try:
-        s3.head_object(Bucket=bucket, Key=key)
-        return True
-    except botocore.exceptions.ClientError as e:
-        if e.response['Error']['Code'] == '404':
-            return False
-        raise
-
 def load_state(report_date):
-    key = STATE_FILE_KEY_TEMPLATE.format(date=report_date.strftime("%Y_%m_%d"))
-    if not s3_object_exists(config["S3_BUCKET"], key):
-        return {"processed_hours": [], "status": "in_progress"}, key
-    resp = s3.get_object(Bucket=config["S3_BUCKET"], Key=key)
-    return json.loads(resp['Body'].read().decode('utf-8')), key
+    key = STATE_FILE_KEY_TEMPLATE.format(
+        date=f"{report_date.year}_{report_date.month:02d}_{report_date.day:02d}")
+    try:
+        resp = get_client('s3').get_object(Bucket=config["S3_BUCKET"], Key=key)
+        state = json.loads(resp['Body'].read().decode('utf-8'))
+    except get_client('s3').exceptions.NoSuchKey:
+        state = {"processed_hours": [], "status": "in_progress"}
+    return state, key
 
 def save_state(report_date, processed_hours, key):
     state = {
         "processed_hours": processed_hours,
         "status": "completed" if len(processed_hours) >= 24 else "in_progress"
     }
-    s3.put_object(
+    get_client('s3').put_object(
         Bucket=config["S3_BUCKET"],
         Key=key,
-        Body=json.dumps(state),
+        Body=json.dumps(state, separators=(',', ':')),
         ContentType="application/json"
     )
 
-def cloudtrail_lookup_with_backoff(params):
-    delay = 1
-    for attempt in range(6):
-        try:
-            return cloudtrail.lookup_events(**params)
-        except botocore.exceptions.ClientError as e:
-            if e.response['Error']['Code'] == 'ThrottlingException':
-                jitter = random.uniform(0, delay)
-                logger.warning(f"Throttled (attempt {attempt+1}), retrying in {delay+jitter:.1f}s...")
-                time.sleep(delay + jitter)
-                delay *= 2
-                continue
-            raise
-    raise RuntimeError("Exceeded max retries")
+def to_est_isoformat(value):
+    # boto3 already returns datetimes; strings only show up if a caller passes raw
+    # JSON through. fromisoformat accepts the trailing "Z" natively on 3.11+.
+    if not isinstance(value, datetime):
+        value = datetime.fromisoformat(value)
+    return value.astimezone(TIMEZONE_EST).isoformat()
+
+def describe_query(query_id):
+    execution = _query_cache.get(query_id)
+    if execution is None:
+        execution = get_client('athena').get_query_execution(QueryExecutionId=query_id).get('QueryExecution', {})
+        if execution.get('Status', {}).get('State') in FINAL_QUERY_STATES:
+            # Lookups run on many threads; evicting iterates the dict, so it
+            # must not race with another thread's insert.
+            with _query_cache_lock:
+                if len(_query_cache) >= QUERY_CACHE_SIZE:
+                    _query_cache.pop(next(iter(_query_cache)), None)
+                _query_cache[query_id] = execution
+    return execution
 
-def extract_event_details(event):
+def parse_event(event):
+    """Build the CloudTrail-only part of a record; no AWS calls are made here."""
     try:
-        detail = json.loads(event.get('CloudTrailEvent', '{}'))
-        if detail.get('eventName') != 'StartQueryExecution':
+        # LookupEvents already filters on EventName; kept as a safeguard.
+        event_name = event.get('EventName')
+        if event_name not in (None, 'StartQueryExecution'):
             return None
         username = event.get('Username') or event.get('UserIdentity', {}).get('UserName', 'unknown')
-        start_time = event.get('EventTime')
-        if not isinstance(start_time, datetime):
-            start_time = datetime.fromisoformat(start_time.replace("Z", "+00:00"))
-        start_est = start_time.astimezone(TIMEZONE_EST).isoformat()
-
-        query_id = detail.get('responseElements', {}).get('queryExecutionId') or \
-                   detail.get('requestParameters', {}).get('queryExecutionId')
-        end_est = "N/A"
-        query_text = "REDACTED"
-        athena_workgroup = "unknown"
-
-        if query_id:
-            try:
-                res = athena.get_query_execution(QueryExecutionId=query_id)
-                comp = res.get('QueryExecution', {}).get('Status', {}).get('CompletionDateTime')
-                if comp:
-                    comp_dt = comp if isinstance(comp, datetime) else datetime.fromisoformat(comp.replace("Z", "+00:00"))
-                    end_est = comp_dt.astimezone(TIMEZONE_EST).isoformat()
-                qstr = res.get('QueryExecution', {}).get('Query')
-                if qstr:
-                    query_text = qstr.strip()
-                wg = res.get('QueryExecution', {}).get('WorkGroup')
-                if wg:
-                    athena_workgroup = wg
-            except Exception as e:
-                logger.warning(f"Error fetching query execution for {query_id}: {e}")
-        return [username, start_est, end_est, query_text, query_id or "N/A", athena_workgroup]
+        start_est = to_est_isoformat(event.get('EventTime'))
+
+        # The query id is the only field needed from the raw CloudTrail JSON, so
+        # pull it out directly and only fall back to a full parse when that fails.
+        raw = event.get('CloudTrailEvent', '{}')
+        match = QUERY_ID_PATTERN.search(raw) if event_name else None
+        if match:
+            query_id = match.group(1)
+        else:
+            detail = json.loads(raw)
+            if detail.get('eventName') != 'StartQueryExecution':
+                return None
+            # Failed calls are recorded with "responseElements": null.
+            query_id = (detail.get('responseElements') or {}).get('queryExecutionId') or \
+                       (detail.get('requestParameters') or {}).get('queryExecutionId')
+        return [username, start_est], query_id
     except Exception as e:
         logger.error(f"Failed to extract event details: {e}")
         return None
 
-def write_csv(report_date, hour, records):
-    suffix = report_date.strftime("%Y_%m_%d")
-    key = (
-        f"daily-report/year={report_date.year}/month={report_date.strftime('%m')}/"
-        f"day={report_date.strftime('%d')}/hour={hour}/report_{suffix}_h{hour}.csv"
+def enrich_with_athena(query_id):
+    """Return (end_est, query_text, workgroup) for a query execution id."""
+    end_est = "N/A"
+    query_text = "REDACTED"
+    athena_workgroup = "unknown"
+
+    if query_id:
+        try:
+            execution = describe_query(query_id)
+            comp = execution.get('Status', {}).get('CompletionDateTime')
+            if comp:
+                end_est = to_est_isoformat(comp)
+            qstr = execution.get('Query')
+            if qstr:
+                query_text = qstr.strip()
+            wg = execution.get('WorkGroup')
+            if wg:
+                athena_workgroup = wg
+        except Exception as e:
+            logger.warning(f"Error fetching query execution for {query_id}: {e}")
+    return end_est, query_text, athena_workgroup
+
+def build_record(partial, query_id):
+    username, start_est = partial
+    end_est, query_text, athena_workgroup = enrich_with_athena(query_id)
+    return [username, start_est, end_est, query_text, query_id or "N/A", athena_workgroup]
+
+def prefetch(iterable, depth=PREFETCH_PAGES):
+    """Drain iterable on a background thread, keeping up to depth items ready."""
+    items = queue.Queue(maxsize=depth)
+    stop = threading.Event()
+
+    def put(item):
+        while not stop.is_set():
+            try:
+                items.put(item, timeout=1)
+                return True
+            except queue.Full:
+                continue
+        return False
+
+    def produce():
+        try:
+            for item in iterable:
+                if not put((True, item)):
+                    return
+            put((False, None))
+        except Exception as e:
+            put((False, e))
+
+    threading.Thread(target=produce, daemon=True).start()
+    try:
+        while True:
+            ok, item = items.get()
+            if not ok:
+                if item is not None:
+                    raise item
+                return
+            yield item
+    finally:
+        stop.set()
+
+def report_key_prefix(report_date, hour):
+    # Plain integer formatting instead of three strftime calls per write.
+    month = f"{report_date.month:02d}"
+    day = f"{report_date.day:02d}"
+    suffix = f"{report_date.year}_{month}_{day}"
+    return (
+        f"daily-report/year={report_date.year}/month={month}/"
+        f"day={day}/hour={hour}/report_{suffix}_h{hour}"
     )
-    output = io.StringIO()
-    writer = csv.writer(output)
-    writer.writerow(["LambdaRunTime(EST)", "Username", "QueryStartTime(EST)", "QueryEndTime(EST)",
-                     "Query", "QueryExecutionId", "Athena_Workgroup"])
+
+def csv_field(value):
+    """Quote a free-text field the same way csv.writer's QUOTE_MINIMAL does."""
+    if CSV_SPECIAL_CHARS.search(value):
+        return '"' + value.replace('"', '""') + '"'
+    return value
+
+def write_csv(key_prefix, records):
+    key = f"{key_prefix}.csv.gz"
+    with tempfile.SpooledTemporaryFile(max_size=UPLOAD_PART_SIZE) as buf:
+        # GzipFile leaves a passed-in fileobj open, so buf survives these blocks.
+        with gzip.GzipFile(fileobj=buf, mode='wb', compresslevel=GZIP_LEVEL) as compressed, \
+                io.TextIOWrapper(compressed, encoding='utf-8', newline='') as output:
+            output.write(CSV_HEADER)
+            run_time = datetime.now(timezone.utc).astimezone(TIMEZONE_EST).isoformat()
+            output.writelines(
+                f"{run_time},{csv_field(username)},{start_time},{end_time},"
+                f"{csv_field(query)},{query_id},{csv_field(workgroup)}\r\n"
+                for username, start_time, end_time, query, query_id, workgroup in records
+            )
+        buf.seek(0)
+        get_client('s3').upload_fileobj(
+            buf, config["S3_BUCKET"], key,
+            ExtraArgs={"ContentEncoding": "gzip", "ContentType": "text/csv"},
+            Config=TRANSFER_CONFIG
+        )
+
+def write_json(key_prefix, records):
+    key = f"{key_prefix}.json.gz"
     run_time = datetime.now(timezone.utc).astimezone(TIMEZONE_EST).isoformat()
-    for rec in records:
-        writer.writerow([run_time, *rec])
-    s3.put_object(Bucket=config["S3_BUCKET"], Key=key, Body=output.getvalue())
+    payload = {"schema": REPORT_FIELDS, "rows": [[run_time, *rec] for rec in records]}
+    get_client('s3').put_object(
+        Bucket=config["S3_BUCKET"],
+        Key=key,
+        Body=gzip.compress(
+            json.dumps(payload, separators=(',', ':'), ensure_ascii=False).encode('utf-8'),
+            compresslevel=GZIP_LEVEL
+        ),
+        ContentEncoding="gzip",
+        ContentType="application/json"
+    )
+
+def write_parquet(key_prefix, records):
+    # pyarrow is not part of the Lambda runtime (attach e.g. the AWS SDK for
+    # pandas layer), so it is only imported when Parquet output is requested.
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+
+    key = f"{key_prefix}.parquet"
+    timestamp = pa.timestamp('us', tz=TIMEZONE_EST.key)
+    schema = pa.schema([
+        ("lambda_runtime", timestamp),
+        ("username", pa.string()),
+        ("start_time", timestamp),
+        ("end_time", timestamp),
+        ("query", pa.string()),
+        ("query_execution_id", pa.string()),
+        ("workgroup", pa.string()),
+    ])
+    run_time = datetime.now(timezone.utc).astimezone(TIMEZONE_EST)
+    table = pa.Table.from_pylist([
+        {
+            "lambda_runtime": run_time,
+            "username": username,
+            "start_time": datetime.fromisoformat(start_time),
+            "end_time": None if end_time == "N/A" else datetime.fromisoformat(end_time),
+            "query": query,
+            "query_execution_id": query_id,
+            "workgroup": workgroup,
+        }
+        for username, start_time, end_time, query, query_id, workgroup in records
+    ], schema=schema)
+
+    buf = io.BytesIO()
+    pq.write_table(table, buf, compression='snappy', use_dictionary=True)
+    buf.seek(0)
+    get_client('s3').upload_fileobj(
+        buf, config["S3_BUCKET"], key,
+        ExtraArgs={"ContentType": "application/vnd.apache.parquet"},
+        Config=TRANSFER_CONFIG
+    )
+
+def write_report(key_prefix, records):
+    # Quiet hours would only produce header-only objects that cost a PUT each
+    # and clutter the partitions Athena has to list.
+    if not records:
+        logger.info(f"No Athena queries for {key_prefix}; skipping report")
+        return
+    output_type = (config.get("OUTPUT_TYPE") or "csv").lower()
+    if output_type == "json":
+        write_json(key_prefix, records)
+    elif output_type == "parquet":
+        write_parquet(key_prefix, records)
+    else:
+        write_csv(key_prefix, records)
 
 def process_hour(report_date, hour, context):
     start_est = report_date.replace(hour=hour, minute=0, second=0, microsecond=0)
@@ -159,21 +368,35 @@ def process_hour(report_date, hour, context):
     start_utc = start_est.astimezone(timezone.utc)
     end_utc = end_est.astimezone(timezone.utc)
 
-    events = []
-    next_token = None
-    while True:
-        params = {"StartTime": start_utc, "EndTime": end_utc, "MaxResults": 50}
-        if next_token:
-            params["NextToken"] = next_token
-        resp = cloudtrail_lookup_with_backoff(params)
-        events.extend(resp.get("Events", []))
-        next_token = resp.get("NextToken")
-        if not next_token:
-            break
-
-    records = [r for e in events if (r := extract_event_details(e))]
-    write_csv(report_date, hour, records)
-    return len(records), len(events)
+    params = {
+        "StartTime": start_utc,
+        "EndTime": end_utc,
+        "LookupAttributes": [{"AttributeKey": "EventName", "AttributeValue": "StartQueryExecution"}],
+        "PaginationConfig": {"PageSize": 50},
+    }
+    pages = get_client('cloudtrail').get_paginator('lookup_events').paginate(**params)
+
+    # The next CloudTrail page is fetched in the background while the Athena
+    # lookups for the current page run on the pool.
+    events_fetched = 0
+    seen = set()
+    futures = []
+    for resp in prefetch(pages):
+        for ev in resp.get("Events", []):
+            events_fetched += 1
+            # CloudTrail can repeat an event across page boundaries; skip it so it
+            # is neither reported twice nor looked up in Athena twice.
+            event_id = ev.get("EventId")
+            if event_id:
+                if event_id in seen:
+                    continue
+                seen.add(event_id)
+            if (parsed := parse_event(ev)):
+                futures.append(athena_executor.submit(build_record, *parsed))
+    records = [f.result() for f in futures]
+
+    write_report(report_key_prefix(report_date, hour), records)
+    return len(records), events_fetched
 
 # -----------------------
 # Lambda Handler
@@ -185,10 +408,32 @@ def lambda_handler(event, context):
     if event.get("source") == "aws.events":
         yesterday = datetime.now(TIMEZONE_EST) - timedelta(days=1)
         date_str = yesterday.strftime("%Y/%m/%d")
+
+        # No Step Function configured: process all 24 hours in this invocation.
+        # Each hour is dominated by CloudTrail/Athena round-trips, so running them
+        # concurrently overlaps the waits. The shared CloudTrail client's adaptive
+        # rate limiter paces all hour threads together under the LookupEvents quota.
+        if not config.get("STATE_MACHINE"):
+            report_date = datetime.strptime(date_str, "%Y/%m/%d").replace(tzinfo=TIMEZONE_EST)
+            with ThreadPoolExecutor(max_workers=HOUR_WORKERS) as ex:
+                results = list(ex.map(lambda h: process_hour(report_date, h, context), range(24)))
+            records_written = sum(r[0] for r in results)
+            events_fetched = sum(r[1] for r in results)
+            logger.info(
+                f"Processed all hours on {date_str}: "
+                f"events_fetched={events_fetched}, records_written={records_written}"
+            )
+            return {
+                "status": "processed",
+                "report_date": date_str,
+                "records_written": records_written,
+                "events_fetched": events_fetched
+            }
+
         hours = [{"hour": h, "report_date": date_str} for h in range(24)]
 
         payload = {"hours": hours}
-        response = stepfunctions.start_execution(
+        response = get_client('stepfunctions').start_execution(
             stateMachineArn=config["STATE_MACHINE"],
             input=json.dumps(payload)
         )